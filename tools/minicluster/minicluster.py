@@ -13,23 +13,46 @@ master or apps can be specified to run in containers as well.
 @contact:    peloton-dev@uber.com
 """
 
+from __future__ import print_function
+
 import os
+import random
 import requests
+import socket
 import sys
+import threading
 import time
 import yaml
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
-from collections import OrderedDict
-from docker import Client
+from concurrent.futures import FIRST_EXCEPTION
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from requests.adapters import HTTPAdapter
+try:
+    from docker import APIClient as Client
+    # docker>=2 lets the connection pool be sized for the shared thread pool
+    client_supports_pool_size = True
+except ImportError:
+    # docker-py < 2.0
+    from docker import Client
+    client_supports_pool_size = False
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 __date__ = '2016-12-08'
 __author__ = 'wu'
 
 max_retry_attempts = 20
 sleep_time_secs = 5
+initial_backoff_secs = 0.25
 healthcheck_path = '/health'
 default_host = 'localhost'
+healthcheck_timeout_secs = 1.0
+max_docker_workers = 16
 
 
 class bcolors:
@@ -41,81 +64,229 @@ class bcolors:
 
 
 def print_okblue(message):
-    print bcolors.OKBLUE + message + bcolors.ENDC
+    print(bcolors.OKBLUE + message + bcolors.ENDC)
 
 
 def print_okgreen(message):
-    print bcolors.OKGREEN + message + bcolors.ENDC
+    print(bcolors.OKGREEN + message + bcolors.ENDC)
 
 
 def print_fail(message):
-    print bcolors.FAIL + message + bcolors.ENDC
+    print(bcolors.FAIL + message + bcolors.ENDC)
 
 
 def print_warn(message):
-    print bcolors.WARNING + message + bcolors.ENDC
+    print(bcolors.WARNING + message + bcolors.ENDC)
 
 
 #
 # Get container local ip.
 # IP address returned is only reachable on the local machine and within
-# the container.
+# the container. Results are cached until the container is removed.
 #
 def get_container_ip(container_name):
-    return os.popen('''
-        docker inspect -f '{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}' %s
-    ''' % container_name).read().strip()
+    ip = container_ips.get(container_name)
+    if ip:
+        return ip
+    info = cli.inspect_container(container_name)
+    ip = ''.join(
+        network['IPAddress']
+        for network in info['NetworkSettings']['Networks'].values()
+    )
+    if ip:
+        container_ips[container_name] = ip
+    return ip
 
 
 #
 # Load configs from file
 #
 def load_config():
-    config_file = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)),
-        "config.yaml")
+    config_file = os.path.join(work_dir, "config.yaml")
     with open(config_file, "r") as f:
-        config = yaml.load(f)
+        config = yaml.load(f, Loader=YamlLoader)
     return config
 
 
 zk_url = None
-cli = Client(base_url='unix://var/run/docker.sock')
+# Container name to local ip, see get_container_ip
+container_ips = {}
+# Image name to the future of its in-flight pull, see prefetch_images
+image_pulls = {}
+if client_supports_pool_size:
+    cli = Client(base_url='unix://var/run/docker.sock',
+                 max_pool_size=max_docker_workers)
+else:
+    cli = Client(base_url='unix://var/run/docker.sock')
+# Docker daemon calls are I/O bound, so they are dispatched concurrently
+# on a shared thread pool.
+pool = ThreadPoolExecutor(max_workers=max_docker_workers)
+# Set when startup fails or is interrupted, so in-flight health checks on
+# the pool stop polling instead of keeping the interpreter alive.
+aborted = threading.Event()
+# Reuse connections across health check polls. Retries are handled by
+# wait_for_up, so the adapter itself never retries.
+health_session = requests.Session()
+health_session.mount('http://', HTTPAdapter(
+    pool_connections=max_docker_workers,
+    pool_maxsize=2 * max_docker_workers,
+    max_retries=0,
+))
 work_dir = os.path.dirname(os.path.abspath(__file__))
 config = load_config()
 
+# Bind mounts shared by the containers
+FILES_BIND = work_dir + '/files:/files'
+MESOS_MASTER_BIND = \
+    work_dir + '/mesos_config/etc_mesos-master:/etc/mesos-master'
+MESOS_SLAVE_BIND = work_dir + '/mesos_config/etc_mesos-slave:/etc/mesos-slave'
+
+
+#
+# Get the additional bind mounts for peloton app containers.
+# BIND_MOUNTS allows additional files to be mounted in the
+# the container. Expected format is a comma-separated list
+# of items of the form <host-path>:<container-path>
+#
+def get_bind_mounts():
+    mounts = os.environ.get("BIND_MOUNTS", "")
+    return mounts.split(",") if mounts else []
+
+
+# Container spec shared by all peloton app instances, start_and_wait only
+# fills in the per-instance name, ports, environment and BIND_MOUNTS.
+PELOTON_BINDS = [FILES_BIND]
+PELOTON_CREATE_KWARGS = dict(
+    # pull or build peloton image if not exists
+    image=config['peloton_image'],
+    detach=True,
+)
+
+
+#
+# Build the container names of every instance, keyed by app
+#
+def get_instance_names():
+    counts = {
+        'peloton_resmgr': config['peloton_resmgr_instance_count'],
+        'peloton_hostmgr': config['peloton_hostmgr_instance_count'],
+        'peloton_jobmgr': config['peloton_jobmgr_instance_count'],
+        'peloton_placement': len(config['peloton_placement_instances']),
+        'peloton_archiver': config['peloton_archiver_instance_count'],
+        'peloton_aurorabridge': config['peloton_aurorabridge_instance_count'],
+        'mesos_agent': config['num_agents'],
+    }
+    return {
+        app: [config[app + '_container'] + str(i) for i in range(count)]
+        for app, count in counts.items()
+    }
+
+
+INSTANCE_NAMES = get_instance_names()
+
 
 #
 # Force remove container by name (best effort)
 #
 def remove_existing_container(name):
+    container_ips.pop(name, None)
     try:
         cli.remove_container(name, force=True)
         print_okblue('removed container %s' % name)
-    except Exception, e:
+    except Exception as e:
+        response = getattr(e, 'response', None)
+        if getattr(response, 'status_code', None) == 404:
+            return
         if 'No such container' in str(e):
             return
         raise e
 
 
 #
-# Teardown mesos related containers.
+# Force remove the named containers concurrently, along with any orphaned
+# containers launched by the mesos agents. Containers are listed once up
+# front so only the ones which actually exist are removed.
 #
-def teardown_mesos():
-    # 1 - Remove all Mesos Agents
-    for i in range(0, config['num_agents']):
-        agent = config['mesos_agent_container'] + repr(i)
-        remove_existing_container(agent)
+def remove_existing_containers(names):
+    existing = set()
+    for c in cli.containers(all=True):
+        for n in c.get('Names') or []:
+            existing.add(n.lstrip('/'))
+
+    to_remove = [n for n in names if n in existing]
+    to_remove.extend(n for n in existing if n.startswith('mesos-'))
+    list(pool.map(remove_existing_container, to_remove))
 
-    # 2 - Remove Mesos Master
-    remove_existing_container(config['mesos_master_container'])
 
-    # 3- Remove orphaned mesos containers.
-    for c in cli.containers(filters={'name': '^/mesos-'}, all=True):
-        remove_existing_container(c.get("Id"))
+#
+# Start pulling images in the background so the downloads overlap with
+# each other and with starting the containers that do not need them.
+# The peloton image is built locally, so it is never pulled.
+# Pulls run on daemon threads rather than the shared pool, so a pull that
+# a failed setup never reaches does not block the interpreter from exiting.
+#
+def prefetch_images(images):
+    for image in images:
+        if image not in image_pulls:
+            image_pulls[image] = submit_daemon(cli.pull, image)
+
+
+#
+# Run a function on a new daemon thread, returning a future of its result.
+#
+def submit_daemon(fn, *args):
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    return future
+
+
+#
+# Drop image pulls which were prefetched but never waited on.
+#
+def discard_image_pulls():
+    for future in image_pulls.values():
+        future.cancel()
+    image_pulls.clear()
+
+
+#
+# Pull an image, waiting for its prefetch to complete if there is one.
+#
+def pull_image(image):
+    future = image_pulls.pop(image, None)
+    if future is None:
+        cli.pull(image)
+    else:
+        future.result()
+
+
+#
+# Names of the mesos related containers.
+#
+def mesos_container_names():
+    names = list(INSTANCE_NAMES['mesos_agent'])
+    names.append(config['mesos_master_container'])
+    names.append(config['zk_container'])
+    return names
+
 
-    # 4 - Remove ZooKeeper
-    remove_existing_container(config['zk_container'])
+#
+# Teardown mesos related containers.
+#
+def teardown_mesos():
+    container_ips.clear()
+    remove_existing_containers(mesos_container_names())
 
 
 #
@@ -126,7 +297,7 @@ def run_mesos():
     teardown_mesos()
 
     # Run zk
-    cli.pull(config['zk_image'])
+    pull_image(config['zk_image'])
     container = cli.create_container(
         name=config['zk_container'],
         hostname=config['zk_container'],
@@ -141,24 +312,24 @@ def run_mesos():
     cli.start(container=container.get('Id'))
     print_okgreen('started container %s' % config['zk_container'])
 
-    # TODO: add retry
-    print_okblue('sleep 20 secs for zk to come up')
-    time.sleep(20)
+    wait_for_zk(default_host, config['local_zk_port'])
+
+    zk_ip = get_container_ip(config['zk_container'])
 
     # Run mesos master
-    cli.pull(config['mesos_master_image'])
+    pull_image(config['mesos_master_image'])
     container = cli.create_container(
         name=config['mesos_master_container'],
         hostname=config['mesos_master_container'],
         volumes=['/files'],
-        ports=[repr(config['master_port'])],
+        ports=[str(config['master_port'])],
         host_config=cli.create_host_config(
             port_bindings={
                 config['master_port']: config['master_port'],
             },
             binds=[
-                work_dir + '/files:/files',
-                work_dir + '/mesos_config/etc_mesos-master:/etc/mesos-master'
+                FILES_BIND,
+                MESOS_MASTER_BIND,
             ],
             privileged=True
         ),
@@ -170,11 +341,11 @@ def run_mesos():
             'MESOS_HTTP_FRAMEWORK_AUTHENTICATORS=basic',
             'MESOS_CREDENTIALS=/etc/mesos-master/credentials',
             'MESOS_LOG_DIR=' + config['log_dir'],
-            'MESOS_PORT=' + repr(config['master_port']),
+            'MESOS_PORT=' + str(config['master_port']),
             'MESOS_ZK=zk://{0}:{1}/mesos'.format(
-                get_container_ip(config['zk_container']),
+                zk_ip,
                 config['default_zk_port']),
-            'MESOS_QUORUM=' + repr(config['quorum']),
+            'MESOS_QUORUM=' + str(config['quorum']),
             'MESOS_REGISTRY=' + config['registry'],
             'MESOS_WORK_DIR=' + config['work_dir'],
         ],
@@ -186,54 +357,52 @@ def run_mesos():
     print_okgreen('started container %s' % config['mesos_master_container'])
 
     # Run mesos slaves
-    cli.pull(config['mesos_slave_image'])
-    for i in range(0, config['num_agents']):
-        agent = config['mesos_agent_container'] + repr(i)
+    agent_env = [
+        'MESOS_MASTER=zk://{0}:{1}/mesos'.format(
+            zk_ip,
+            config['default_zk_port']
+        ),
+        'MESOS_SWITCH_USER=' + str(config['switch_user']),
+        'MESOS_CONTAINERIZERS=' + config['containers'],
+        'MESOS_LOG_DIR=' + config['log_dir'],
+        'MESOS_ISOLATION=' + config['isolation'],
+        'MESOS_SYSTEMD_ENABLE_SUPPORT=false',
+        'MESOS_IMAGE_PROVIDERS=' + config['image_providers'],
+        'MESOS_IMAGE_PROVISIONER_BACKEND={0}'.format(
+            config['image_provisioner_backend']
+        ),
+        'MESOS_APPC_STORE_DIR=' + config['appc_store_dir'],
+        'MESOS_WORK_DIR=' + config['work_dir'],
+        'MESOS_RESOURCES=' + config['resources'],
+        'MESOS_ATTRIBUTES=' + config['attributes'],
+        'MESOS_MODULES=' + config['modules'],
+        'MESOS_RESOURCE_ESTIMATOR=' + config['resource_estimator'],
+        'MESOS_OVERSUBSCRIBED_RESOURCES_INTERVAL='
+        + config['oversubscribed_resources_interval'],
+        'MESOS_QOS_CONTROLLER=' + config['qos_controller'],
+        'MESOS_QOS_CORRECTION_INTERVAL_MIN='
+        + config['qos_correction_interval_min'],
+    ]
+
+    def run_agent(i, agent):
         port = config['local_agent_port'] + i
         container = cli.create_container(
             name=agent,
             hostname=agent,
             volumes=['/files', '/var/run/docker.sock'],
-            ports=[repr(config['default_agent_port'])],
+            ports=[str(config['default_agent_port'])],
             host_config=cli.create_host_config(
                 port_bindings={
                     config['default_agent_port']: port,
                 },
                 binds=[
-                    work_dir + '/files:/files',
-                    work_dir +
-                    '/mesos_config/etc_mesos-slave:/etc/mesos-slave',
+                    FILES_BIND,
+                    MESOS_SLAVE_BIND,
                     '/var/run/docker.sock:/var/run/docker.sock',
                 ],
                 privileged=True,
             ),
-            environment=[
-                'MESOS_PORT=' + repr(port),
-                'MESOS_MASTER=zk://{0}:{1}/mesos'.format(
-                    get_container_ip(config['zk_container']),
-                    config['default_zk_port']
-                ),
-                'MESOS_SWITCH_USER=' + repr(config['switch_user']),
-                'MESOS_CONTAINERIZERS=' + config['containers'],
-                'MESOS_LOG_DIR=' + config['log_dir'],
-                'MESOS_ISOLATION=' + config['isolation'],
-                'MESOS_SYSTEMD_ENABLE_SUPPORT=false',
-                'MESOS_IMAGE_PROVIDERS=' + config['image_providers'],
-                'MESOS_IMAGE_PROVISIONER_BACKEND={0}'.format(
-                    config['image_provisioner_backend']
-                ),
-                'MESOS_APPC_STORE_DIR=' + config['appc_store_dir'],
-                'MESOS_WORK_DIR=' + config['work_dir'],
-                'MESOS_RESOURCES=' + config['resources'],
-                'MESOS_ATTRIBUTES=' + config['attributes'],
-                'MESOS_MODULES=' + config['modules'],
-                'MESOS_RESOURCE_ESTIMATOR=' + config['resource_estimator'],
-                'MESOS_OVERSUBSCRIBED_RESOURCES_INTERVAL='
-                + config['oversubscribed_resources_interval'],
-                'MESOS_QOS_CONTROLLER=' + config['qos_controller'],
-                'MESOS_QOS_CORRECTION_INTERVAL_MIN='
-                + config['qos_correction_interval_min'],
-            ],
+            environment=['MESOS_PORT=' + str(port)] + agent_env,
             image=config['mesos_slave_image'],
             entrypoint='bash /files/run_mesos_slave.sh',
             detach=True,
@@ -241,13 +410,17 @@ def run_mesos():
         cli.start(container=container.get('Id'))
         print_okgreen('started container %s' % agent)
 
+    pull_image(config['mesos_slave_image'])
+    agents = INSTANCE_NAMES['mesos_agent']
+    list(pool.map(run_agent, range(len(agents)), agents))
+
 
 #
 # Run cassandra cluster
 #
 def run_cassandra():
     remove_existing_container(config['cassandra_container'])
-    cli.pull(config['cassandra_image'])
+    pull_image(config['cassandra_image'])
     container = cli.create_container(
         name=config['cassandra_container'],
         hostname=config['cassandra_container'],
@@ -258,7 +431,7 @@ def run_cassandra():
                     config['cassandra_thrift_port'],
             },
             binds=[
-                work_dir + '/files:/files',
+                FILES_BIND,
             ],
         ),
         environment=['MAX_HEAP_SIZE=1G', 'HEAP_NEWSIZE=256M'],
@@ -280,22 +453,22 @@ def create_cassandra_store():
     retry_attempts = 0
     while retry_attempts < max_retry_attempts:
         time.sleep(sleep_time_secs)
-        setup_exe = cli.exec_create(
-            container=config['cassandra_container'],
-            cmd='/files/setup_cassandra.sh',
-        )
-        show_exe = cli.exec_create(
+        # setup and verification are run in a single exec so that each
+        # attempt costs one create/start round trip to the daemon
+        exe = cli.exec_create(
             container=config['cassandra_container'],
-            cmd='cqlsh -e "describe %s"' % config['cassandra_test_db'],
+            cmd=[
+                'bash', '-c',
+                '/files/setup_cassandra.sh && cqlsh -e "describe %s"'
+                % config['cassandra_test_db'],
+            ],
         )
         # by api design, exec_start needs to be called after exec_create
         # to run 'docker exec'
-        resp = cli.exec_start(exec_id=setup_exe)
-        if resp is "":
-            resp = cli.exec_start(exec_id=show_exe)
-            if "CREATE KEYSPACE peloton_test WITH" in resp:
-                print_okgreen('cassandra store is created')
-                return
+        resp = cli.exec_start(exec_id=exe).decode('utf-8')
+        if "CREATE KEYSPACE peloton_test WITH" in resp:
+            print_okgreen('cassandra store is created')
+            return
         print_warn('failed to create cassandra store, retrying...')
         retry_attempts += 1
 
@@ -312,12 +485,40 @@ def run_peloton(applications):
     print_okblue('docker image "uber/peloton" has to be built first '
                  'locally by running IMAGE=uber/peloton make docker')
 
-    for app, func in APP_START_ORDER.iteritems():
-        if app in applications:
-            should_disable = applications[app]
-            if should_disable:
-                continue
-        APP_START_ORDER[app]()
+    # a previous failed run in the same process must not abort this one
+    aborted.clear()
+
+    # Apps within a wave are independent of each other, so all their
+    # instances are started concurrently and the next wave only begins
+    # once every instance of the current wave is up.
+    for wave in APP_START_ORDER:
+        futures = []
+        try:
+            for app in wave:
+                if applications.get(app, False):
+                    continue
+                futures.extend(APP_RUNNERS[app]())
+            wait(futures, return_when=FIRST_EXCEPTION)
+            for f in futures:
+                # re-raise any failure to start an instance
+                f.result()
+        except BaseException:
+            aborted.set()
+            for f in futures:
+                f.cancel()
+            raise
+
+
+#
+# Replaces any existing container of the same name, starts it and waits
+# for it to come up. Returns a future which completes once it is up.
+#
+def submit_start_and_wait(application_name, container_name, ports,
+                          extra_env=None):
+    def run():
+        remove_existing_container(container_name)
+        start_and_wait(application_name, container_name, ports, extra_env)
+    return pool.submit(run)
 
 
 #
@@ -327,26 +528,23 @@ def start_and_wait(application_name, container_name, ports, extra_env=None):
     # TODO: It's very implicit that the first port is the HTTP port, perhaps we
     # should split it out even more.
     election_zk_servers = None
-    mesos_zk_path = None
     if zk_url is not None:
         election_zk_servers = zk_url
-        mesos_zk_path = 'zk://{0}/mesos'.format(zk_url)
     else:
         election_zk_servers = '{0}:{1}'.format(
             get_container_ip(config['zk_container']),
             config['default_zk_port'])
-        mesos_zk_path = 'zk://{0}:{1}/mesos'.format(
-            get_container_ip(config['zk_container']),
-            config['default_zk_port'])
+    mesos_zk_path = 'zk://{0}/mesos'.format(election_zk_servers)
+    cassandra_ip = get_container_ip(config['cassandra_container'])
     env = {
         'CONFIG_DIR': 'config',
         'APP': application_name,
         'HTTP_PORT': ports[0],
-        'DB_HOST': get_container_ip(config['cassandra_container']),
+        'DB_HOST': cassandra_ip,
         'ELECTION_ZK_SERVERS': election_zk_servers,
         'MESOS_ZK_PATH': mesos_zk_path,
         'MESOS_SECRET_FILE': '/files/hostmgr_mesos_secret',
-        'CASSANDRA_HOSTS': get_container_ip(config['cassandra_container']),
+        'CASSANDRA_HOSTS': cassandra_ip,
         'ENABLE_DEBUG_LOGGING': config['debug'],
         'DATACENTER': '',
         # used to migrate the schema;used inside host manager
@@ -357,31 +555,20 @@ def start_and_wait(application_name, container_name, ports, extra_env=None):
         env['GRPC_PORT'] = ports[1]
     if extra_env:
         env.update(extra_env)
-    environment = []
-    for key, value in env.iteritems():
-        environment.append('%s=%s' % (key, value))
-    # BIND_MOUNTS allows additional files to be mounted in the
-    # the container. Expected format is a comma-separated list
-    # of items of the form <host-path>:<container-path>
-    mounts = os.environ.get("BIND_MOUNTS", "")
-    mounts = mounts.split(",") if mounts else []
+    environment = ['%s=%s' % kv for kv in env.items()]
     container = cli.create_container(
         name=container_name,
         hostname=container_name,
-        ports=[repr(port) for port in ports],
+        ports=[str(port) for port in ports],
         environment=environment,
         host_config=cli.create_host_config(
             port_bindings={
                 port: port
                 for port in ports
             },
-            binds=[
-                work_dir + '/files:/files',
-            ] + mounts,
+            binds=PELOTON_BINDS + get_bind_mounts(),
         ),
-        # pull or build peloton image if not exists
-        image=config['peloton_image'],
-        detach=True,
+        **PELOTON_CREATE_KWARGS
     )
     cli.start(container=container.get('Id'))
     wait_for_up(
@@ -395,112 +582,163 @@ def start_and_wait(application_name, container_name, ports, extra_env=None):
 #
 def run_peloton_resmgr():
     # TODO: move docker run logic into a common function for all apps to share
-    for i in range(0, config['peloton_resmgr_instance_count']):
+    futures = []
+    for i, name in enumerate(INSTANCE_NAMES['peloton_resmgr']):
         # to not cause port conflicts among apps, increase port by 10
         # for each instance
         ports = [port + i * 10 for port in config['peloton_resmgr_ports']]
-        name = config['peloton_resmgr_container'] + repr(i)
-        remove_existing_container(name)
-        start_and_wait('resmgr', name, ports)
+        futures.append(submit_start_and_wait('resmgr', name, ports))
+    return futures
 
 
 #
 # Run peloton hostmgr app
 #
 def run_peloton_hostmgr():
-    for i in range(0, config['peloton_hostmgr_instance_count']):
+    futures = []
+    scarce_resource = ','.join(config['scarce_resource_types'])
+    slack_resource = ','.join(config['slack_resource_types'])
+    for i, name in enumerate(INSTANCE_NAMES['peloton_hostmgr']):
         # to not cause port conflicts among apps, increase port
         # by 10 for each instance
         ports = [port + i * 10 for port in config['peloton_hostmgr_ports']]
-        scarce_resource = ','.join(config['scarce_resource_types'])
-        slack_resource = ','.join(config['slack_resource_types'])
-        name = config['peloton_hostmgr_container'] + repr(i)
-        remove_existing_container(name)
-        start_and_wait('hostmgr', name, ports,
-                       extra_env={'SCARCE_RESOURCE_TYPES': scarce_resource,
-                                  'SLACK_RESOURCE_TYPES': slack_resource})
+        future = submit_start_and_wait(
+            'hostmgr', name, ports,
+            extra_env={'SCARCE_RESOURCE_TYPES': scarce_resource,
+                       'SLACK_RESOURCE_TYPES': slack_resource})
+        if i == 0:
+            # wait for the first instance to run the schema migrations
+            # before starting any other instance
+            future.result()
+        futures.append(future)
+    return futures
 
 
 #
 # Run peloton jobmgr app
 #
 def run_peloton_jobmgr():
-    for i in range(0, config['peloton_jobmgr_instance_count']):
+    futures = []
+    for i, name in enumerate(INSTANCE_NAMES['peloton_jobmgr']):
         # to not cause port conflicts among apps, increase port by 10
         #  for each instance
         ports = [port + i * 10 for port in config['peloton_jobmgr_ports']]
-        name = config['peloton_jobmgr_container'] + repr(i)
-        remove_existing_container(name)
-        start_and_wait('jobmgr', name, ports,
-                       extra_env={'MESOS_AGENT_WORK_DIR': config['work_dir'],
-                                  'JOB_TYPE': os.getenv('JOB_TYPE', 'BATCH')})
+        futures.append(submit_start_and_wait(
+            'jobmgr', name, ports,
+            extra_env={'MESOS_AGENT_WORK_DIR': config['work_dir'],
+                       'JOB_TYPE': os.getenv('JOB_TYPE', 'BATCH')}))
+    return futures
 
 
 #
 # Run peloton aurora bridge app
 #
 def run_peloton_aurorabridge():
-    for i in range(0, config['peloton_aurorabridge_instance_count']):
+    futures = []
+    for i, name in enumerate(INSTANCE_NAMES['peloton_aurorabridge']):
         ports = \
             [port + i * 10 for port in config['peloton_aurorabridge_ports']]
-        name = config['peloton_aurorabridge_container'] + repr(i)
-        remove_existing_container(name)
-        start_and_wait('aurorabridge', name, ports)
+        futures.append(submit_start_and_wait('aurorabridge', name, ports))
+    return futures
 
 
 #
 # Run peloton placement app
 #
 def run_peloton_placement():
-    i = 0
-    for task_type in config['peloton_placement_instances']:
+    futures = []
+    for i, (name, task_type) in enumerate(zip(
+            INSTANCE_NAMES['peloton_placement'],
+            config['peloton_placement_instances'])):
         # to not cause port conflicts among apps, increase port by 10
         # for each instance
         ports = [port + i * 10 for port in config['peloton_placement_ports']]
-        name = config['peloton_placement_container'] + repr(i)
-        remove_existing_container(name)
-        start_and_wait('placement', name, ports,
-                       extra_env={'TASK_TYPE': task_type})
-        i = i + 1
+        futures.append(submit_start_and_wait(
+            'placement', name, ports, extra_env={'TASK_TYPE': task_type}))
+    return futures
 
 
 #
 # Run peloton archiver app
 #
 def run_peloton_archiver():
-    for i in range(0, config['peloton_archiver_instance_count']):
+    futures = []
+    for i, name in enumerate(INSTANCE_NAMES['peloton_archiver']):
         ports = [port + i * 10 for port in config['peloton_archiver_ports']]
-        name = config['peloton_archiver_container'] + repr(i)
-        remove_existing_container(name)
-        start_and_wait('archiver', name, ports)
+        futures.append(submit_start_and_wait('archiver', name, ports))
+    return futures
 
 
 #
 # Run health check for peloton apps
 #
 def wait_for_up(app, port):
-    count = 0
     error = ''
+    delay = initial_backoff_secs
     url = 'http://%s:%s/%s' % (
         default_host,
         port,
         healthcheck_path,
     )
-    while count < max_retry_attempts:
+    # polls start fast and back off, but the app always gets the full
+    # max_retry_attempts * sleep_time_secs to come up
+    timeout_secs = max_retry_attempts * sleep_time_secs
+    deadline = time.time() + timeout_secs
+    while True:
+        if aborted.is_set():
+            raise Exception('aborted waiting for %s on %d' % (app, port))
         try:
-            r = requests.get(url)
+            r = health_session.get(url, timeout=healthcheck_timeout_secs)
             if r.status_code == 200:
                 print_okgreen('started %s' % app)
                 return
-        except Exception, e:
-            print_warn('app %s is not up yet, retrying...' % app)
+            error = 'unexpected status code %d' % r.status_code
+        except Exception as e:
             error = str(e)
-            time.sleep(sleep_time_secs)
-            count += 1
-
-    raise Exception('failed to start %s on %d after %d attempts, err: %s' %
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        print_warn('app %s is not up yet, retrying...' % app)
+        # back off exponentially up to sleep_time_secs, with jitter so
+        # that concurrently started apps do not poll in lockstep
+        aborted.wait(min(delay * (0.5 + random.random()), remaining))
+        delay = min(delay * 2, sleep_time_secs)
+
+    raise Exception('failed to start %s on %d after %d secs, err: %s' %
                     (
                         app,
+                        port,
+                        timeout_secs,
+                        error,
+                    )
+                    )
+
+
+#
+# Run health check for zk using its 'ruok' four letter command
+#
+def wait_for_zk(host, port):
+    error = ''
+    delay = initial_backoff_secs
+    for _ in range(max_retry_attempts):
+        try:
+            s = socket.create_connection((host, port), 1)
+            try:
+                s.sendall(b'ruok')
+                if s.recv(4) == b'imok':
+                    print_okgreen('started zk')
+                    return
+                error = 'zk is not ok'
+            finally:
+                s.close()
+        except Exception as e:
+            error = str(e)
+        print_warn('zk is not up yet, retrying...')
+        time.sleep(delay * (0.5 + random.random()))
+        delay = min(delay * 2, sleep_time_secs)
+
+    raise Exception('failed to start zk on %d after %d attempts, err: %s' %
+                    (
                         port,
                         max_retry_attempts,
                         error,
@@ -512,9 +750,21 @@ def wait_for_up(app, port):
 # Set up a personal cluster
 #
 def setup(disable_mesos=False, applications={}, enable_peloton=False):
-    run_cassandra()
+    images = [config['cassandra_image']]
     if not disable_mesos:
-        run_mesos()
+        images.extend([
+            config['zk_image'],
+            config['mesos_master_image'],
+            config['mesos_slave_image'],
+        ])
+    prefetch_images(images)
+
+    try:
+        run_cassandra()
+        if not disable_mesos:
+            run_mesos()
+    finally:
+        discard_image_pulls()
 
     if enable_peloton:
         run_peloton(
@@ -527,39 +777,15 @@ def setup(disable_mesos=False, applications={}, enable_peloton=False):
 # TODO (wu): use docker labels when launching containers
 #            and then remove all containers with that label
 def teardown():
-    # 1 - Remove jobmgr instances
-    for i in range(0, config['peloton_jobmgr_instance_count']):
-        name = config['peloton_jobmgr_container'] + repr(i)
-        remove_existing_container(name)
-
-    # 2 - Remove placement engine instances
-    for i in range(0, len(config['peloton_placement_instances'])):
-        name = config['peloton_placement_container'] + repr(i)
-        remove_existing_container(name)
-
-    # 3 - Remove resmgr instances
-    for i in range(0, config['peloton_resmgr_instance_count']):
-        name = config['peloton_resmgr_container'] + repr(i)
-        remove_existing_container(name)
-
-    # 4 - Remove hostmgr instances
-    for i in range(0, config['peloton_hostmgr_instance_count']):
-        name = config['peloton_hostmgr_container'] + repr(i)
-        remove_existing_container(name)
-
-    # 5 - Remove archiver instances
-    for i in range(0, config['peloton_archiver_instance_count']):
-        name = config['peloton_archiver_container'] + repr(i)
-        remove_existing_container(name)
-
-    # 6 - Remove aurorabridge instances
-    for i in range(0, config['peloton_aurorabridge_instance_count']):
-        name = config['peloton_aurorabridge_container'] + repr(i)
-        remove_existing_container(name)
+    names = []
+    for app, app_names in INSTANCE_NAMES.items():
+        if app.startswith('peloton_'):
+            names.extend(app_names)
 
-    teardown_mesos()
+    names.extend(mesos_container_names())
+    names.append(config['cassandra_container'])
 
-    remove_existing_container(config['cassandra_container'])
+    remove_existing_containers(names)
 
 
 def parse_arguments():
@@ -663,16 +889,27 @@ class App:
     AURORABRIDGE = 6
 
 
-# Defines the order in which the apps are started
+# Maps each app to the function which submits its instances for startup
+APP_RUNNERS = {
+    App.HOST_MANAGER: run_peloton_hostmgr,
+    App.RESOURCE_MANAGER: run_peloton_resmgr,
+    App.PLACEMENT_ENGINE: run_peloton_placement,
+    App.JOB_MANAGER: run_peloton_jobmgr,
+    App.ARCHIVER: run_peloton_archiver,
+    App.AURORABRIDGE: run_peloton_aurorabridge,
+}
+
+# Defines the waves in which the apps are started. Apps in the same wave
+# are started concurrently, waves are started in order.
 # NB: HOST_MANAGER is tied to database migrations so should be started first
-APP_START_ORDER = OrderedDict([
-    (App.HOST_MANAGER, run_peloton_hostmgr),
-    (App.RESOURCE_MANAGER, run_peloton_resmgr),
-    (App.PLACEMENT_ENGINE, run_peloton_placement),
-    (App.JOB_MANAGER, run_peloton_jobmgr),
-    (App.ARCHIVER, run_peloton_archiver),
-    (App.AURORABRIDGE, run_peloton_aurorabridge)]
-)
+APP_START_ORDER = [
+    [App.HOST_MANAGER],
+    [App.RESOURCE_MANAGER,
+     App.PLACEMENT_ENGINE,
+     App.JOB_MANAGER,
+     App.ARCHIVER,
+     App.AURORABRIDGE],
+]
 
 
 def main():
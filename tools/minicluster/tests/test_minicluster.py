@@ -0,0 +1,541 @@
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# The docker client connects to the daemon when it is created, so it is
+# stubbed out while importing the module.
+with mock.patch('docker.APIClient', create=True):
+    from tools.minicluster import minicluster
+
+
+class FakeDockerClient(object):
+    """
+    Stub of the docker client which records the calls made to it.
+    """
+
+    def __init__(self, containers=None, missing=None, exec_outputs=None):
+        self._containers = containers or []
+        self._missing = set(missing or [])
+        self._exec_outputs = list(exec_outputs or [])
+        self.removed = []
+        self.created = []
+        self.inspected = []
+        self.pulled = []
+        self.execs = []
+
+    def containers(self, all=False):
+        return self._containers
+
+    def remove_container(self, name, force=False):
+        if name in self._missing:
+            raise Exception('No such container: %s' % name)
+        self.removed.append(name)
+
+    def inspect_container(self, name):
+        self.inspected.append(name)
+        return {'NetworkSettings': {'Networks': {
+            'bridge': {'IPAddress': '172.17.0.%d' % len(self.inspected)},
+        }}}
+
+    def pull(self, image):
+        self.pulled.append(image)
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def create_container(self, **kwargs):
+        self.created.append(kwargs)
+        return {'Id': kwargs['name']}
+
+    def start(self, container):
+        pass
+
+    def exec_create(self, container, cmd):
+        self.execs.append(cmd)
+        return len(self.execs)
+
+    def exec_start(self, exec_id):
+        return self._exec_outputs.pop(0)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeSocket(object):
+    def __init__(self, reply):
+        self._reply = reply
+
+    def sendall(self, data):
+        pass
+
+    def recv(self, size):
+        return self._reply
+
+    def close(self):
+        pass
+
+
+class RunPelotonTest(unittest.TestCase):
+
+    def tearDown(self):
+        minicluster.aborted.clear()
+
+    def _runner(self, app, fn, calls):
+        def run():
+            calls.append(app)
+            return [minicluster.pool.submit(fn)]
+        return run
+
+    def test_runs_waves_in_order(self):
+        calls = []
+        runners = {
+            minicluster.App.HOST_MANAGER:
+                self._runner('hostmgr', str, calls),
+            minicluster.App.JOB_MANAGER: self._runner('jobmgr', str, calls),
+            minicluster.App.ARCHIVER: self._runner('archiver', str, calls),
+        }
+        with mock.patch.object(minicluster, 'APP_RUNNERS', runners), \
+                mock.patch.object(
+                    minicluster, 'APP_START_ORDER',
+                    [[minicluster.App.HOST_MANAGER],
+                     [minicluster.App.JOB_MANAGER,
+                      minicluster.App.ARCHIVER]]):
+            minicluster.run_peloton({minicluster.App.ARCHIVER: True})
+
+        self.assertEqual(calls, ['hostmgr', 'jobmgr'])
+
+    def test_failed_wave_aborts_later_waves(self):
+        calls = []
+
+        def fail():
+            raise Exception('failed to start')
+
+        runners = {
+            minicluster.App.HOST_MANAGER:
+                self._runner('hostmgr', fail, calls),
+            minicluster.App.JOB_MANAGER: self._runner('jobmgr', str, calls),
+        }
+        with mock.patch.object(minicluster, 'APP_RUNNERS', runners), \
+                mock.patch.object(
+                    minicluster, 'APP_START_ORDER',
+                    [[minicluster.App.HOST_MANAGER],
+                     [minicluster.App.JOB_MANAGER]]):
+            self.assertRaises(Exception, minicluster.run_peloton, {})
+
+        self.assertEqual(calls, ['hostmgr'])
+        self.assertTrue(minicluster.aborted.is_set())
+
+    def test_runs_after_failed_run(self):
+        def fail():
+            raise Exception('failed to start')
+
+        def start():
+            minicluster.wait_for_up('jobmgr', 5292)
+
+        order = [[minicluster.App.JOB_MANAGER]]
+        with mock.patch.object(minicluster, 'APP_START_ORDER', order):
+            with mock.patch.object(
+                    minicluster, 'APP_RUNNERS',
+                    {minicluster.App.JOB_MANAGER:
+                     self._runner('jobmgr', fail, [])}):
+                self.assertRaises(Exception, minicluster.run_peloton, {})
+
+            with mock.patch.object(
+                    minicluster, 'APP_RUNNERS',
+                    {minicluster.App.JOB_MANAGER:
+                     self._runner('jobmgr', start, [])}), \
+                    mock.patch.object(minicluster.health_session, 'get',
+                                      return_value=FakeResponse(200)):
+                minicluster.run_peloton({})
+
+    def test_starts_first_hostmgr_alone(self):
+        events = []
+
+        def submit(app, name, ports, extra_env=None):
+            events.append('submit ' + name)
+            future = mock.Mock()
+            future.result.side_effect = \
+                lambda: events.append('wait ' + name)
+            return future
+
+        names = dict(minicluster.INSTANCE_NAMES,
+                     peloton_hostmgr=['hostmgr0', 'hostmgr1', 'hostmgr2'])
+        with mock.patch.object(minicluster, 'INSTANCE_NAMES', names), \
+                mock.patch.object(minicluster, 'submit_start_and_wait',
+                                  side_effect=submit):
+            futures = minicluster.run_peloton_hostmgr()
+
+        self.assertEqual(len(futures), 3)
+        self.assertEqual(
+            events,
+            ['submit hostmgr0', 'wait hostmgr0',
+             'submit hostmgr1', 'submit hostmgr2'])
+
+    def test_wait_for_up_stops_when_aborted(self):
+        minicluster.aborted.set()
+        with mock.patch.object(minicluster.health_session, 'get') as get:
+            self.assertRaises(
+                Exception, minicluster.wait_for_up, 'jobmgr', 5292)
+
+        self.assertFalse(get.called)
+
+
+class FakeClock(object):
+    """
+    Clock which only advances when something waits on it.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.waits = []
+
+    def time(self):
+        return self.now
+
+    def wait(self, secs):
+        self.waits.append(secs)
+        self.now += secs
+
+
+class WaitForUpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        aborted = mock.Mock()
+        aborted.is_set.return_value = False
+        aborted.wait.side_effect = self.clock.wait
+        patches = [
+            mock.patch.object(minicluster, 'aborted', aborted),
+            mock.patch.object(minicluster.time, 'time',
+                              side_effect=self.clock.time),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_returns_when_healthy(self):
+        with mock.patch.object(
+                minicluster.health_session, 'get',
+                side_effect=[Exception('refused'),
+                             FakeResponse(503),
+                             FakeResponse(200)]) as get:
+            minicluster.wait_for_up('jobmgr', 5292)
+
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual(len(self.clock.waits), 2)
+        # the first polls are sub-second
+        self.assertTrue(all(w < 1 for w in self.clock.waits))
+
+    def test_backs_off_until_deadline(self):
+        timeout = minicluster.max_retry_attempts * minicluster.sleep_time_secs
+        start = self.clock.now
+        with mock.patch.object(
+                minicluster.health_session, 'get',
+                return_value=FakeResponse(503)) as get:
+            self.assertRaises(
+                Exception, minicluster.wait_for_up, 'jobmgr', 5292)
+
+        # the app gets the full timeout, and is polled once more at the end
+        self.assertAlmostEqual(self.clock.now - start, timeout)
+        self.assertEqual(get.call_count, len(self.clock.waits) + 1)
+        # exponential backoff with jitter in [0.5, 1.5) of the delay,
+        # capped at sleep_time_secs, except for the last wait which is
+        # cut short at the deadline
+        for i, secs in enumerate(self.clock.waits[:-1]):
+            base = min(minicluster.initial_backoff_secs * 2 ** i,
+                       minicluster.sleep_time_secs)
+            self.assertTrue(0.5 * base <= secs < 1.5 * base)
+
+
+class GetContainerIpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cli = FakeDockerClient()
+        patches = [
+            mock.patch.object(minicluster, 'cli', self.cli),
+            mock.patch.dict(minicluster.container_ips, clear=True),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_caches_ip(self):
+        self.assertEqual(
+            minicluster.get_container_ip('peloton-zk'), '172.17.0.1')
+        self.assertEqual(
+            minicluster.get_container_ip('peloton-zk'), '172.17.0.1')
+        self.assertEqual(self.cli.inspected, ['peloton-zk'])
+
+    def test_does_not_cache_missing_ip(self):
+        self.cli.inspect_container = mock.Mock(return_value={
+            'NetworkSettings': {'Networks': {}},
+        })
+        self.assertEqual(minicluster.get_container_ip('peloton-zk'), '')
+        self.assertEqual(minicluster.container_ips, {})
+
+    def test_remove_invalidates_ip(self):
+        minicluster.get_container_ip('peloton-zk')
+        minicluster.get_container_ip('peloton-cassandra')
+        minicluster.remove_existing_container('peloton-zk')
+
+        self.assertEqual(
+            minicluster.get_container_ip('peloton-zk'), '172.17.0.3')
+        self.assertEqual(
+            minicluster.get_container_ip('peloton-cassandra'), '172.17.0.2')
+
+    def test_teardown_mesos_clears_ips(self):
+        minicluster.get_container_ip('peloton-cassandra')
+        with mock.patch.object(minicluster, 'remove_existing_containers'):
+            minicluster.teardown_mesos()
+
+        self.assertEqual(minicluster.container_ips, {})
+
+
+class RemoveExistingContainersTest(unittest.TestCase):
+
+    def test_removes_existing_and_orphans(self):
+        cli = FakeDockerClient(
+            containers=[
+                {'Id': '1', 'Names': ['/peloton-zk']},
+                {'Id': '2', 'Names': ['/mesos-orphan']},
+                {'Id': '3', 'Names': ['/unrelated']},
+            ],
+        )
+        with mock.patch.object(minicluster, 'cli', cli):
+            minicluster.remove_existing_containers(
+                ['peloton-zk', 'peloton-mesos-master'])
+
+        self.assertEqual(
+            sorted(cli.removed), ['mesos-orphan', 'peloton-zk'])
+
+    def test_ignores_already_removed(self):
+        cli = FakeDockerClient(
+            containers=[
+                {'Id': '1', 'Names': ['/peloton-zk']},
+                {'Id': '2', 'Names': ['/mesos-orphan']},
+            ],
+            missing=['mesos-orphan'],
+        )
+        with mock.patch.object(minicluster, 'cli', cli):
+            minicluster.remove_existing_containers(['peloton-zk'])
+
+        self.assertEqual(cli.removed, ['peloton-zk'])
+
+
+class PrefetchImagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cli = FakeDockerClient()
+        patches = [
+            mock.patch.object(minicluster, 'cli', self.cli),
+            mock.patch.dict(minicluster.image_pulls, clear=True),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_pull_image_waits_for_prefetch(self):
+        minicluster.prefetch_images(['zk', 'zk', 'cassandra'])
+        minicluster.pull_image('zk')
+        minicluster.pull_image('cassandra')
+
+        self.assertEqual(sorted(self.cli.pulled), ['cassandra', 'zk'])
+        self.assertEqual(minicluster.image_pulls, {})
+
+    def test_prefetch_runs_on_daemon_threads(self):
+        daemon = []
+        self.cli.pull = mock.Mock(
+            side_effect=lambda image: daemon.append(
+                minicluster.threading.current_thread().daemon))
+        minicluster.prefetch_images(['zk'])
+        minicluster.pull_image('zk')
+
+        self.assertEqual(daemon, [True])
+
+    def test_pull_image_without_prefetch(self):
+        minicluster.pull_image('zk')
+
+        self.assertEqual(self.cli.pulled, ['zk'])
+
+    def test_pull_image_raises_prefetch_failure(self):
+        self.cli.pull = mock.Mock(side_effect=Exception('not found'))
+        minicluster.prefetch_images(['zk'])
+
+        self.assertRaises(Exception, minicluster.pull_image, 'zk')
+
+    def test_setup_failure_discards_prefetched_pulls(self):
+        with mock.patch.object(minicluster, 'run_cassandra',
+                               side_effect=SystemExit(1)), \
+                mock.patch.object(minicluster, 'run_mesos') as run_mesos:
+            self.assertRaises(SystemExit, minicluster.setup)
+
+        self.assertFalse(run_mesos.called)
+        self.assertEqual(minicluster.image_pulls, {})
+
+    def test_setup_discards_unused_pulls(self):
+        with mock.patch.object(minicluster, 'run_cassandra'), \
+                mock.patch.object(minicluster, 'run_mesos',
+                                  side_effect=Exception('zk is not up')):
+            self.assertRaises(Exception, minicluster.setup)
+
+        self.assertEqual(minicluster.image_pulls, {})
+
+
+@mock.patch.object(minicluster, 'max_retry_attempts', 5)
+@mock.patch.object(minicluster.time, 'sleep')
+class WaitForZkTest(unittest.TestCase):
+
+    def test_returns_when_ok(self, sleep):
+        with mock.patch.object(
+                minicluster.socket, 'create_connection',
+                side_effect=[Exception('refused'),
+                             FakeSocket(b'imok')]) as connect:
+            minicluster.wait_for_zk('localhost', 8192)
+
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_fails_after_limit(self, sleep):
+        with mock.patch.object(
+                minicluster.socket, 'create_connection',
+                return_value=FakeSocket(b'')) as connect:
+            self.assertRaises(
+                Exception, minicluster.wait_for_zk, 'localhost', 8192)
+
+        self.assertEqual(connect.call_count, 5)
+        self.assertEqual(sleep.call_count, 5)
+
+
+def start_archiver(cli, environ=None):
+    """
+    Run start_and_wait for an archiver instance against the stub client
+    and return the kwargs it created the container with.
+    """
+    with mock.patch.object(minicluster, 'cli', cli), \
+            mock.patch.object(minicluster, 'get_container_ip',
+                              return_value='1.2.3.4'), \
+            mock.patch.object(minicluster, 'wait_for_up') as wait, \
+            mock.patch.dict(minicluster.os.environ, environ or {}):
+        minicluster.start_and_wait(
+            'archiver', 'peloton-archiver0', [5295, 5395])
+    wait.assert_called_once_with('peloton-archiver0', 5295)
+    assert len(cli.created) == 1
+    return cli.created[0]
+
+
+class StartAndWaitTest(unittest.TestCase):
+
+    def test_exposes_and_publishes_ports(self):
+        created = start_archiver(FakeDockerClient())
+
+        self.assertEqual(created['ports'], ['5295', '5395'])
+        self.assertEqual(
+            created['host_config']['port_bindings'],
+            {5295: 5295, 5395: 5395})
+
+    def test_environment(self):
+        created = start_archiver(FakeDockerClient())
+
+        env = dict(e.split('=', 1) for e in created['environment'])
+        self.assertEqual(env['APP'], 'archiver')
+        self.assertEqual(env['HTTP_PORT'], '5295')
+        self.assertEqual(env['GRPC_PORT'], '5395')
+        self.assertEqual(env['DB_HOST'], '1.2.3.4')
+
+
+@mock.patch.object(minicluster, 'max_retry_attempts', 3)
+@mock.patch.object(minicluster.time, 'sleep')
+class CreateCassandraStoreTest(unittest.TestCase):
+
+    created = b'CREATE KEYSPACE peloton_test WITH replication = {}'
+
+    def test_single_exec_per_attempt(self, sleep):
+        cli = FakeDockerClient(exec_outputs=[self.created])
+        with mock.patch.object(minicluster, 'cli', cli):
+            minicluster.create_cassandra_store()
+
+        self.assertEqual(len(cli.execs), 1)
+        cmd = cli.execs[0]
+        self.assertEqual(cmd[:2], ['bash', '-c'])
+        self.assertEqual(
+            cmd[2],
+            '/files/setup_cassandra.sh && '
+            'cqlsh -e "describe peloton_test"')
+
+    def test_retries_until_created(self, sleep):
+        cli = FakeDockerClient(exec_outputs=[
+            b'Connection error: Unable to connect', self.created])
+        with mock.patch.object(minicluster, 'cli', cli):
+            minicluster.create_cassandra_store()
+
+        self.assertEqual(len(cli.execs), 2)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_exits_after_limit(self, sleep):
+        cli = FakeDockerClient(exec_outputs=[b'error'] * 3)
+        with mock.patch.object(minicluster, 'cli', cli):
+            self.assertRaises(
+                SystemExit, minicluster.create_cassandra_store)
+
+        self.assertEqual(len(cli.execs), 3)
+
+
+class GetInstanceNamesTest(unittest.TestCase):
+
+    def test_names_per_app(self):
+        config = minicluster.config
+        names = minicluster.get_instance_names()
+
+        self.assertEqual(
+            names['peloton_hostmgr'],
+            ['peloton-hostmgr%d' % i
+             for i in range(config['peloton_hostmgr_instance_count'])])
+        self.assertEqual(
+            names['peloton_placement'],
+            ['peloton-placement%d' % i
+             for i in range(len(config['peloton_placement_instances']))])
+        self.assertEqual(
+            names['mesos_agent'],
+            ['peloton-mesos-agent%d' % i
+             for i in range(config['num_agents'])])
+
+    def test_teardown_removes_every_instance(self):
+        with mock.patch.object(
+                minicluster, 'remove_existing_containers') as remove, \
+                mock.patch.object(minicluster, 'cli', FakeDockerClient()):
+            minicluster.teardown()
+
+        removed = remove.call_args[0][0]
+        for names in minicluster.INSTANCE_NAMES.values():
+            for name in names:
+                self.assertIn(name, removed)
+        self.assertIn(minicluster.config['cassandra_container'], removed)
+
+
+class PelotonContainerSpecTest(unittest.TestCase):
+
+    def test_uses_shared_spec(self):
+        created = start_archiver(FakeDockerClient())
+
+        self.assertEqual(created['image'], minicluster.config['peloton_image'])
+        self.assertTrue(created['detach'])
+        self.assertEqual(
+            created['host_config']['binds'], [minicluster.FILES_BIND])
+
+    def test_reads_bind_mounts_per_call(self):
+        created = start_archiver(
+            FakeDockerClient(), {'BIND_MOUNTS': '/a:/b,/c:/d'})
+
+        self.assertEqual(
+            created['host_config']['binds'],
+            [minicluster.FILES_BIND, '/a:/b', '/c:/d'])
+        self.assertEqual(minicluster.PELOTON_BINDS, [minicluster.FILES_BIND])
+
+
+if __name__ == '__main__':
+    unittest.main()